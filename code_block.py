@@ -12,52 +12,282 @@
 # The output directory will be the directory with "_out" appending to
 # the input directory
 #
-# 1. Find comments from the source files, find the markers and write
+# 1. Find marker comments from the source files and write
 #   out a mapping from the makrers to their path and line numbers.
 # 2. Make a copy of the README files and replace the README side marker
 #   with the path and line numbers.
 #
-# Requires:
-#  - `comment_parser`
-#
 # Assumptions:
-#  - The source files should have correct extension so that the MIME
-#     types can be determined.
+#  - Markers are written in a `#`, `//`, `/*` or `<!--` comment. Only Python
+#     files are tokenized, so in other languages a marker inside a string
+#     literal is also found.
 #  - Have https://github.com/karolswdev/autodocs-markdown-docker docker
 #     ready.
 #  - Markdown output directory need to be in the same level/structure of the
 #     input (i.e. from ./input/ to ./output/, not ./input/ to ./some/output/)
 #  - Rely on certain string pattern to do the replacement (such as `&`).
-#  - Comment tags should be simple ascii names (no special characters).
+#  - Comment tags should be simple ascii names (letters, digits, `_`, `.`, `-`).
 #  - Comment tags cannot be nested.
 
+import functools
+import io
 import os
+import shlex
 import shutil
+import subprocess
 import sys
 import re
 import logging
-import mimetypes
-from typing import Dict, Iterator, List, Tuple
-
-from comment_parser import parsers
-from comment_parser import comment_parser as cp
-from comment_parser.comment_parser import UnsupportedError
+import tokenize
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 
 
 COMMENT_MARKER_BEGIN = "SOURCE_MARKER_BEGIN"
 COMMENT_MARKER_END = "SOURCE_MARKER_END"
-COMMENT_AUTODOC_BEGIN_PATTERN = (
-    "<!-- MARKDOWN-AUTO-DOCS:START \(CODE:src=(.*?)&label=(\w+).*?\) -->"
+
+# Compiled once at import, this is run over the whole content of a markdown
+# file and matches the autodoc markers that start a line.
+AUTODOC_RE = re.compile(
+    r"^[ \t]*<!-- MARKDOWN-AUTO-DOCS:START \(CODE:src=(.*?)&label=(\w+).*?\) -->",
+    re.MULTILINE,
 )
+# Files not containing this literal cannot match `AUTODOC_RE`.
+_AUTODOC_PREFIX_BYTES = b"<!-- MARKDOWN-AUTO-DOCS:START (CODE:"
+
+# Finds both kinds of source markers following a comment token, the groups are
+# the marker kind and the block name. The name is made of ascii letters, digits,
+# `_`, `.` and `-`, and must be followed by a whitespace or the end of the
+# comment, so a marker quoted in a string (e.g. `"// SOURCE_MARKER_END_x";`)
+# does not match.
+SOURCE_MARKER_RE = re.compile(
+    r"(?:#|//|/\*|<!--)[ \t]*(%s|%s)_([\w.-]+?)(?=\s|\*/|-->|$)"
+    % (COMMENT_MARKER_BEGIN, COMMENT_MARKER_END),
+    re.MULTILINE | re.ASCII,
+)
+
+# Byte forms of the markers, used to skip files before decoding them.
+_BEGIN_MARKER_BYTES = COMMENT_MARKER_BEGIN.encode()
+_END_MARKER_BYTES = COMMENT_MARKER_END.encode()
 
-# Setting up MIME type.
-cp.MIME_MAP.update({"application/x-sh": parsers.shell_parser})
+# Source trees with fewer files than this are scanned in the current process.
+_PARALLEL_SCAN_MIN_FILES = 256
+# Number of files sent to a worker process at a time.
+_SCAN_CHUNK_SIZE = 16
+
+# The literal shared by both markers, searched for before running the regex.
+_MARKER_PREFIX = os.path.commonprefix([COMMENT_MARKER_BEGIN, COMMENT_MARKER_END])
+
+
+def iter_tree(some_path: str) -> Iterator[os.DirEntry]:
+    """Recursively iterate the entries under a directory.
+
+    Unlike `os.walk`, the `os.DirEntry` objects from `os.scandir` are yielded
+    directly, so their cached file types can be reused without extra `stat`
+    calls. A directory is yielded right before its content, and symbolic links
+    to directories are not followed (nor yielded), same as `os.walk`. Also like
+    `os.walk`, directories that cannot be scanned (e.g. missing or unreadable)
+    are skipped silently.
+
+    Args:
+        some_path (str): The directory to iterate.
+
+    Returns:
+        An iterator of the directory entries.
+    """
+    try:
+        it = os.scandir(some_path)
+    except OSError:
+        return
+
+    with it:
+        while True:
+            try:
+                entry = next(it)
+            except StopIteration:
+                break
+            except OSError:
+                return
+
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+
+            if is_dir:
+                if not entry.is_symlink():
+                    yield entry
+                    yield from iter_tree(entry.path)
+            else:
+                yield entry
 
 
 def list_files(some_path: str) -> Iterator[str]:
-    for dirpath, dnames, fnames in os.walk(some_path):
-        for f in fnames:
-            yield os.path.join(dirpath, f)
+    for entry in iter_tree(some_path):
+        if not entry.is_dir():
+            yield entry.path
+
+
+def python_comment_starts(text: str) -> Optional[Set[Tuple[int, int]]]:
+    """Find where the comments start in a Python source.
+
+    This is used to tell the markers in real comments from the ones inside
+    strings, such as the examples in docstrings.
+
+    Args:
+        text (str): The content of a Python source file.
+
+    Returns:
+        The set of the line numbers and columns of the comment tokens, or
+        None if the text cannot be tokenized.
+    """
+    try:
+        return {
+            token.start
+            for token in tokenize.generate_tokens(io.StringIO(text).readline)
+            if token.type == tokenize.COMMENT
+        }
+    except (tokenize.TokenError, SyntaxError):
+        return None
+
+
+def iter_markers(
+    text: str, comment_starts: Optional[Set[Tuple[int, int]]] = None
+) -> Iterator[Tuple[str, str, int, int]]:
+    """Find all the source markers in a text.
+
+    The shared marker literal is located with `str.find` first, and
+    `SOURCE_MARKER_RE` is only matched on the lines containing it, so the
+    regex engine does not need to try every position of the text.
+
+    Args:
+        text (str): The content of a source file.
+        comment_starts (Optional[Set[Tuple[int, int]]]): If given, only the
+            markers whose comment token starts at one of these line numbers
+            and columns are kept.
+
+    Returns:
+        An iterator of the marker kind, the block name, the line number and
+        the offset where the marker line ends.
+    """
+    lineno, last_pos = 1, 0
+    pos = text.find(_MARKER_PREFIX)
+    while pos != -1:
+        line_start = text.rfind("\n", 0, pos) + 1
+        line_end = text.find("\n", pos)
+        if line_end == -1:
+            line_end = len(text)
+        lineno += text.count("\n", last_pos, line_start)
+        last_pos = line_start
+
+        for matched in SOURCE_MARKER_RE.finditer(text, line_start, line_end):
+            if (
+                comment_starts is None
+                or (lineno, matched.start() - line_start) in comment_starts
+            ):
+                marker, name = matched.groups()
+                yield marker, name, lineno, line_end
+
+        # All the markers of this line are done, continue from the next line.
+        pos = text.find(_MARKER_PREFIX, line_end)
+
+
+def take_block(
+    block_lines: List[str], start_lineno: int, end_lineno: int, strip_empty: bool
+) -> Tuple[int, int]:
+    empty_begins, empty_ends = 0, 0
+
+    if strip_empty:
+        for l in block_lines:
+            if l.strip() == "":
+                empty_begins += 1
+            else:
+                break
+
+        for l in reversed(block_lines):
+            if l.strip() == "":
+                empty_ends += 1
+            else:
+                break
+
+    return start_lineno + empty_begins, end_lineno - 1 - empty_ends
+
+
+def _scan_one(
+    fn: str, strip_empty_line: bool
+) -> Tuple[str, Dict[str, str], Optional[str]]:
+    """Find the code blocks enclosed by the markers in a single source file.
+
+    Args:
+        fn (str): The path of the source file.
+        strip_empty_line (bool): strip the empty lines at the start and end of the block.
+
+    Returns:
+        The absolute path of the file, the mapping from the marker name to
+        the locations (empty if the file has no markers), and a message to be
+        logged by the caller, since this may run in a worker process where
+        logging is not set up.
+    """
+    fullpath = os.path.abspath(fn)
+    blocks = {}
+
+    # A plain substring check is much cheaper than decoding and
+    # scanning, and most files do not contain any marker.
+    with open(fn, "rb") as f:
+        data = f.read()
+    if _BEGIN_MARKER_BYTES not in data and _END_MARKER_BYTES not in data:
+        return fullpath, blocks, None
+
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError:
+        return fullpath, blocks, f"Ignoring non-text file {fn}"
+
+    comment_starts = None
+    if fn.endswith(".py"):
+        comment_starts = python_comment_starts(text)
+
+    block_name = ""
+    lineno = -1
+    begin_line_end = -1
+    for marker, name, marker_lineno, line_end in iter_markers(text, comment_starts):
+        if marker == COMMENT_MARKER_BEGIN:
+            block_name = name
+            lineno = marker_lineno
+            begin_line_end = line_end
+            continue
+
+        if not block_name:
+            raise RuntimeError(
+                "Found end marker [%s] without a begin marker, scanning %s at "
+                "line %d." % (name, fn, marker_lineno)
+            )
+
+        if name == block_name:
+            # Only split the lines from after the begin marker to the end marker,
+            # instead of the whole file.
+            block_lines = (
+                text[begin_line_end + 1 : line_end].split("\n")
+                if strip_empty_line
+                else []
+            )
+
+            block_begin, block_end = take_block(
+                block_lines, lineno, marker_lineno, strip_empty_line,
+            )
+
+            if block_end <= block_begin:
+                raise RuntimeError("Incorrect code block line numbers.")
+
+            blocks[block_name] = f"lines={block_begin}-{block_end}"
+            block_name = ""
+        else:
+            raise RuntimeError(
+                "Unbalanced comment markers, scanning %s, "
+                "found marker name [%s] at line %d, and [%s] at line %d."
+                % (fn, block_name, lineno, name, marker_lineno,)
+            )
+    return fullpath, blocks, f"Parsing file {fn}"
 
 
 def scan_sources(source_dirs: List[str], strip_empty_line: bool) -> Dict[str, str]:
@@ -71,8 +301,10 @@ def scan_sources(source_dirs: List[str], strip_empty_line: bool) -> Dict[str, st
 
         Note:
             - Cannot handle nested markers.
-            - Support limited MIME types from https://github.com/jeanralphaviles/comment_parser
-            - Use # style inline comments for all other file types now. 
+            - Markers are found with `SOURCE_MARKER_RE`, so they need to be in
+              a `#`, `//`, `/*` or `<!--` comment. Only Python files are
+              tokenized, so in other languages a marker inside a string
+              literal is also found.
 
         .. code-block:: python
             import sys
@@ -106,100 +338,66 @@ def scan_sources(source_dirs: List[str], strip_empty_line: bool) -> Dict[str, st
     """
     marker_mapping = {}
 
-    def take_block(
-        text_file: str, start_lineno: int, end_lineno: int, strip_empty: bool
-    ):
-        empty_begins, empty_ends = 0, 0
-
-        if strip_empty:
-            with open(text_file, encoding="utf-8") as f:
-                all_lines = f.readlines()[start_lineno:end_lineno]
-
-                for l in all_lines:
-                    if l.strip() == "":
-                        empty_begins += 1
-                    else:
-                        break
-
-                for l in reversed(all_lines):
-                    if l.strip() == "":
-                        empty_ends += 1
-                    else:
-                        break
-
-        return start_lineno + empty_begins, end_lineno - 1 - empty_ends
-
-    for src_dir in source_dirs:
-        for fn in list_files(src_dir):
-            mime_type, _ = mimetypes.guess_type(fn)
-
-            if mime_type is None:
-                # Just try to use regular shell style comment
-                mime_type = "text/x-shellscript"
-
-            try:
-                block_name = ""
-                lineno = -1
-                for comment in cp.extract_comments(fn, mime_type):
-                    ctext = comment.text().strip()
-                    if ctext.startswith(COMMENT_MARKER_BEGIN):
-                        block_name = re.sub("^" + COMMENT_MARKER_BEGIN + "_", "", ctext)
-                        lineno = comment.line_number()
-
-                    if ctext.startswith(COMMENT_MARKER_END):
-                        block_name_end = re.sub(
-                            "^" + COMMENT_MARKER_END + "_", "", ctext
-                        )
-                        if block_name_end == block_name:
-                            block_begin, block_end = take_block(
-                                fn, lineno, comment.line_number(), strip_empty_line,
-                            )
-
-                            if block_end <= block_begin:
-                                raise RuntimeError("Incorrect code block line numbers.")
-
-                            fullpath = os.path.abspath(fn)
-
-                            if fullpath not in marker_mapping:
-                                marker_mapping[fullpath] = {}
-
-                            marker_mapping[fullpath][
-                                block_name
-                            ] = f"lines={block_begin}-{block_end}"
-                        else:
-                            raise RuntimeError(
-                                "Unbalanced comment markers, scanning %s, "
-                                "found marker name [%s] at line %d, and [%s] at line %d."
-                                % (
-                                    fn,
-                                    block_name,
-                                    0,
-                                    block_name_end,
-                                    comment.line_number(),
-                                )
-                            )
-                logging.info("Parsing file %s of type %s", fn, mime_type)
-            except UnicodeDecodeError:
-                logging.info("Ignoring non-text file %s", fn)
-            except UnsupportedError:
-                logging.info("Ignoring Unsupported file %s of type %s", fn, mime_type)
+    all_files = [fn for src_dir in source_dirs for fn in list_files(src_dir)]
+    scan_one = functools.partial(_scan_one, strip_empty_line=strip_empty_line)
+
+    def add_results(results: Iterator[Tuple[str, Dict[str, str], Optional[str]]]):
+        for fullpath, blocks, log_message in results:
+            if log_message:
+                logging.info(log_message)
+            if blocks:
+                marker_mapping[fullpath] = blocks
+
+    if len(all_files) < _PARALLEL_SCAN_MIN_FILES:
+        # Starting the worker processes costs more than scanning a few files.
+        add_results(map(scan_one, all_files))
+    else:
+        # Files are scanned independently, so spread them over the CPUs.
+        num_chunks = -(-len(all_files) // _SCAN_CHUNK_SIZE)
+        with ProcessPoolExecutor(
+            max_workers=min(os.cpu_count() or 1, num_chunks)
+        ) as executor:
+            add_results(
+                executor.map(scan_one, all_files, chunksize=_SCAN_CHUNK_SIZE)
+            )
 
     return marker_mapping
 
 
-def run_autodoc(markdown_path: str):
-    """Run autodoc on the input file.
+def run_autodoc(markdown_paths: List[str]):
+    """Run autodoc on the input files.
+
+    All the files are passed to a single autodoc run, so the docker container
+    is only started once.
 
     Args:
-        markdown_path (str): The input markdown path.
+        markdown_paths (List[str]): The input markdown paths.
     """
-    script = (
-        f"docker run -v $(pwd):/data -it karolswdev/autodocs-markdown-docker"
-        + f" -c code-block -o {markdown_path}"
-    )
+    if isinstance(markdown_paths, str):
+        raise TypeError(
+            "run_autodoc takes a list of markdown paths, "
+            f"got a single path {markdown_paths!r}."
+        )
+
+    command = [
+        "docker",
+        "run",
+        "-v",
+        f"{os.getcwd()}:/data",
+        "-i",
+        "karolswdev/autodocs-markdown-docker",
+        "-c",
+        "code-block",
+        "-o",
+        *markdown_paths,
+    ]
     logging.info(f"Running Auto Doc command:")
-    logging.info(script)
-    status = os.system(script)
+    logging.info(shlex.join(command))
+    try:
+        status = subprocess.run(command).returncode
+    except OSError as e:
+        # e.g. docker is not installed, report it like a failed run.
+        raise RuntimeError(f"Command run unsuccessful, {e}") from e
 
     if not status == 0:
         raise RuntimeError(f"Command run unsuccessful, return status is {status}")
@@ -215,48 +413,69 @@ def prepare_markdown(
     will be replaced to the following given the mapping: `"some_name": "path/to/source&3-4"`
     `<!-- MARKDOWN-AUTO-DOCS:START (CODE:src=path/to/source&3-4) -->`
 
+    Note:
+        - This does not run autodoc on the copy, so the code blocks are not
+          filled in yet. The caller needs to pass the copies that are replaced
+          to `run_autodoc`, as `prepare_all_markdowns` does.
+
     Args:
         markdown_path (str): The path to the input markdown file.
         copy_path (str): The path to copy the markdown to.
         markder_dict (Dict[str, str]): A mapping from the marker to the locations.
 
     Returns:
-        A boolean value representing whether something is replaced.
+        A boolean value representing whether something is replaced, i.e.
+        whether `copy_path` needs to be passed to `run_autodoc`.
     """
     is_replaced = False
-
-    with open(markdown_path, encoding="utf-8") as f, open(
-        copy_path, "w", encoding="utf-8"
-    ) as out:
-        for line in f:
-            matched = re.match(COMMENT_AUTODOC_BEGIN_PATTERN, line.strip())
-            if matched:
-                if len(matched.groups()) > 2:
-                    raise RuntimeError(
-                        f"Should not have more than 2 matched groups in AUTODOC pattern at {f}"
-                    )
-
-                src_path_in_markdown, marker_label = matched.groups()
-
-                src_path = os.path.join(
-                    os.path.dirname(markdown_path), src_path_in_markdown
-                )
-                full_src_path = os.path.abspath(src_path)
-
-                if full_src_path in marker_dict:
-                    replace_label = marker_dict[full_src_path][marker_label]
-                else:
-                    raise RuntimeError(
-                        f"Tag [{marker_label}] in a source file {full_src_path} "
-                        f"cannot be found in the markdown file [{markdown_path}]."
-                    )
-                is_replaced = True
-                out.write(line.replace("&label=" + marker_label, "&" + replace_label))
+    markdown_dir = os.path.dirname(markdown_path)
+
+    with open(markdown_path, "rb") as f:
+        data = f.read()
+
+    # Most markdown files have no autodoc marker, just copy them over.
+    if _AUTODOC_PREFIX_BYTES not in data:
+        shutil.copyfile(markdown_path, copy_path)
+        return is_replaced
+
+    # The source markers of each path written in this markdown, so that the
+    # path is only resolved once however many blocks are taken from it.
+    local_cache: Dict[str, Dict[str, str]] = {}
+
+    def replace(matched: re.Match) -> str:
+        if len(matched.groups()) > 2:
+            raise RuntimeError(
+                "Should not have more than 2 matched groups in AUTODOC pattern "
+                f"at {markdown_path}"
+            )
+
+        src_path_in_markdown, marker_label = matched.groups()
+
+        src_markers = local_cache.get(src_path_in_markdown)
+        if src_markers is None:
+            src_path = os.path.join(markdown_dir, src_path_in_markdown)
+            full_src_path = os.path.abspath(src_path)
+
+            if full_src_path in marker_dict:
+                src_markers = local_cache[src_path_in_markdown] = marker_dict[
+                    full_src_path
+                ]
             else:
-                out.write(line)
+                raise RuntimeError(
+                    f"Tag [{marker_label}] in a source file {full_src_path} "
+                    f"cannot be found in the markdown file [{markdown_path}]."
+                )
 
-    if is_replaced:
-        run_autodoc(copy_path)
+        replace_label = src_markers[marker_label]
+        return matched.group(0).replace("&label=" + marker_label, "&" + replace_label)
+
+    # Substitute all the markers in one pass over the whole content.
+    text, num_replaced = AUTODOC_RE.subn(replace, data.decode("utf-8"))
+    is_replaced = num_replaced > 0
+
+    # The line endings are kept as they are, same as the copied files.
+    with open(copy_path, "w", encoding="utf-8", newline="") as out:
+        out.write(text)
 
     return is_replaced
 
@@ -265,7 +484,8 @@ def prepare_all_markdowns(
     markdown_dir: str, target_dir: str, marker_dict: Dict[str, str]
 ) -> Tuple[List[str], List[str], List[str]]:
     """Given a directory containing markdown files, replace the markdown content and copy
-    them to the `target_dir`, trying to keep the same directory structure.
+    them to the `target_dir`, trying to keep the same directory structure. The replaced
+    markdown files are then filled in by a single autodoc run.
 
     Note:
         - Find markdown files using the ".md" extension.
@@ -282,24 +502,32 @@ def prepare_all_markdowns(
           - The third one contains other files (non-markdown) that are copied.
     """
     summary = [], [], []
-    for dirpath, _, fnames in os.walk(markdown_dir):
-        structure = os.path.join(target_dir, os.path.relpath(dirpath, markdown_dir))
-        if not os.path.isdir(structure):
-            os.makedirs(structure)
-
-        for fname in fnames:
-            src_file = os.path.join(dirpath, fname)
-            target_file = os.path.normpath(os.path.join(structure, fname))
-
-            if fname.endswith(".md"):
-                # Replacing auto-doc comments
-                if prepare_markdown(src_file, target_file, marker_dict,):
-                    summary[0].append(target_file)
-                else:
-                    summary[1].append(target_file)
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+
+    for entry in iter_tree(markdown_dir):
+        target_file = os.path.normpath(
+            os.path.join(target_dir, os.path.relpath(entry.path, markdown_dir))
+        )
+
+        if entry.is_dir():
+            if not os.path.isdir(target_file):
+                os.makedirs(target_file)
+        elif entry.name.endswith(".md"):
+            # Replacing auto-doc comments
+            if prepare_markdown(entry.path, target_file, marker_dict):
+                summary[0].append(target_file)
             else:
-                shutil.copyfile(src_file, target_file)
-                summary[2].append(target_file)
+                summary[1].append(target_file)
+        else:
+            # Since Python 3.8 this already copies in the kernel (`os.sendfile`
+            # on Linux, `fcopyfile` on macOS).
+            shutil.copyfile(entry.path, target_file)
+            summary[2].append(target_file)
+
+    if summary[0]:
+        run_autodoc(summary[0])
+
     return summary
 
 
@@ -1,5 +1,6 @@
 # SOURCE_MARKER_BEGIN_import
 import nltk
+from nltk.tag.perceptron import PerceptronTagger
 from forte.processors.base import PackProcessor
 from forte.data.data_pack import DataPack
 from ft.onto.base_ontology import Token
@@ -13,20 +14,25 @@ class NLTKPOSTagger(PackProcessor):
 
     def initialize(self, resources, configs):
         super().initialize(resources, configs)
-        # download the NLTK average perceptron tagger
-        nltk.download("averaged_perceptron_tagger")
+        # download the NLTK average perceptron tagger if it is missing
+        try:
+            nltk.data.find("taggers/averaged_perceptron_tagger")
+        except LookupError:
+            nltk.download("averaged_perceptron_tagger", quiet=True)
+        # load the tagger model once instead of on every `nltk.pos_tag` call
+        self.tagger = PerceptronTagger()
 
     def _process(self, input_pack: DataPack):
         # get a list of token data entries from `input_pack`
         # using `DataPack.get()`` method
-        token_texts = [token.text for token in input_pack.get(Token)]
+        tokens = list(input_pack.get(Token))
 
-        # use nltk pos tagging module to tag token texts
-        taggings = nltk.pos_tag(token_texts)
+        # use the nltk perceptron tagger to tag token texts
+        taggings = self.tagger.tag([token.text for token in tokens])
 
         # assign nltk taggings to token attributes
-        for token, tag in zip(input_pack.get(Token), taggings):
-            token.pos = tag[1]
+        for token, (_, tag) in zip(tokens, taggings):
+            token.pos = tag
 
 
 # SOURCE_MARKER_END_class
@@ -0,0 +1,245 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import code_block
+
+
+class ListFilesTest(unittest.TestCase):
+    def test_missing_directory_is_skipped(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            missing = os.path.join(tmp_dir, "does_not_exist")
+            self.assertEqual(list(code_block.list_files(missing)), [])
+
+    def test_unreadable_directory_is_skipped(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(os.path.join(tmp_dir, "locked"))
+            kept = os.path.join(tmp_dir, "kept.txt")
+            open(kept, "w").close()
+
+            scandir = os.scandir
+
+            def failing_scandir(path):
+                if os.path.basename(path) == "locked":
+                    raise PermissionError(path)
+                return scandir(path)
+
+            with mock.patch("os.scandir", failing_scandir):
+                self.assertEqual(list(code_block.list_files(tmp_dir)), [kept])
+
+
+class ScanSourcesTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.source_dir = self._tmp_dir.name
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _write(self, name: str, content: str) -> str:
+        path = os.path.join(self.source_dir, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+        return os.path.abspath(path)
+
+    def _scan(self):
+        return code_block.scan_sources([self.source_dir], strip_empty_line=True)
+
+    def test_own_docstring_example_is_ignored(self):
+        with open(code_block.__file__, encoding="utf-8") as f:
+            self._write("code_block.py", f.read())
+
+        self.assertEqual(self._scan(), {})
+
+    def test_python_docstring_example_is_ignored(self):
+        path = self._write(
+            "example.py",
+            'def f():\n'
+            '    """\n'
+            '    # SOURCE_MARKER_BEGIN_ex\n'
+            '    print("in docstring")\n'
+            '    # SOURCE_MARKER_END_ex\n'
+            '    """\n'
+            '    # SOURCE_MARKER_BEGIN_body\n'
+            '    return 1\n'
+            '    # SOURCE_MARKER_END_body\n',
+        )
+
+        self.assertEqual(self._scan(), {path: {"body": "lines=7-8"}})
+
+    def test_marker_after_code(self):
+        path = self._write(
+            "trailing.py",
+            "x = 1  # SOURCE_MARKER_BEGIN_foo\n"
+            "y = 2\n"
+            "z = 3\n"
+            "# SOURCE_MARKER_END_foo\n",
+        )
+
+        self.assertEqual(self._scan(), {path: {"foo": "lines=1-3"}})
+
+    def test_block_names_are_not_truncated(self):
+        path = self._write(
+            "names.java",
+            "// SOURCE_MARKER_BEGIN_foo-bar\n"
+            "int a = 1;\n"
+            "int b = 2;\n"
+            "// SOURCE_MARKER_END_foo-bar\n"
+            "/* SOURCE_MARKER_BEGIN_baz.qux */\n"
+            "int c = 3;\n"
+            "int d = 4;\n"
+            "/* SOURCE_MARKER_END_baz.qux */\n",
+        )
+
+        self.assertEqual(
+            self._scan(), {path: {"foo-bar": "lines=1-3", "baz.qux": "lines=5-7"}},
+        )
+
+    def test_marker_in_string_literal_is_ignored(self):
+        path = self._write(
+            "quoted.java",
+            'String s = "// SOURCE_MARKER_END_y";\n'
+            "// SOURCE_MARKER_BEGIN_block\n"
+            "int a = 1;\n"
+            "int b = 2;\n"
+            "// SOURCE_MARKER_END_block\n"
+            "<!-- SOURCE_MARKER_BEGIN_html-->\n"
+            "<p>x</p>\n"
+            "<!-- SOURCE_MARKER_END_html-->\n",
+        )
+
+        self.assertEqual(
+            self._scan(), {path: {"block": "lines=2-4", "html": "lines=6-7"}},
+        )
+
+    def test_end_marker_without_begin(self):
+        self._write(
+            "stray.sh",
+            "echo start\n"
+            "# SOURCE_MARKER_END_stray\n",
+        )
+
+        with self.assertRaisesRegex(RuntimeError, r"stray\.sh at line 2"):
+            self._scan()
+
+
+class PrepareMarkdownTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.markdown_path = os.path.join(self._tmp_dir.name, "README.md")
+        self.copy_path = os.path.join(self._tmp_dir.name, "README_out.md")
+        self.marker_dict = {
+            os.path.join(os.path.abspath(self._tmp_dir.name), "src.py"): {
+                "foo": "lines=1-3",
+                "bar": "lines=5-6",
+            }
+        }
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _prepare(self, content: bytes):
+        with open(self.markdown_path, "wb") as f:
+            f.write(content)
+        is_replaced = code_block.prepare_markdown(
+            self.markdown_path, self.copy_path, self.marker_dict
+        )
+        with open(self.copy_path, "rb") as f:
+            return is_replaced, f.read()
+
+    def test_markdown_without_marker_is_copied(self):
+        content = b"# Title\r\n\nNothing to replace here.\n\xff"
+
+        with mock.patch("shutil.copyfile", wraps=shutil.copyfile) as copyfile:
+            self.assertEqual(self._prepare(content), (False, content))
+        copyfile.assert_called_once_with(self.markdown_path, self.copy_path)
+
+    def test_label_is_replaced(self):
+        content = (
+            b"Text\n"
+            b"<!-- MARKDOWN-AUTO-DOCS:START (CODE:src=src.py&label=foo) -->\n"
+            b"<!-- MARKDOWN-AUTO-DOCS:END -->\n"
+            b"  <!-- MARKDOWN-AUTO-DOCS:START (CODE:src=./src.py&label=bar) -->\n"
+            b"  <!-- MARKDOWN-AUTO-DOCS:END -->\n"
+        )
+
+        self.assertEqual(
+            self._prepare(content),
+            (
+                True,
+                b"Text\n"
+                b"<!-- MARKDOWN-AUTO-DOCS:START (CODE:src=src.py&lines=1-3) -->\n"
+                b"<!-- MARKDOWN-AUTO-DOCS:END -->\n"
+                b"  <!-- MARKDOWN-AUTO-DOCS:START (CODE:src=./src.py&lines=5-6) -->\n"
+                b"  <!-- MARKDOWN-AUTO-DOCS:END -->\n",
+            ),
+        )
+
+    def test_line_endings_are_kept(self):
+        content = (
+            b"Text\r\n"
+            b"<!-- MARKDOWN-AUTO-DOCS:START (CODE:src=src.py&label=foo) -->\r\n"
+            b"<!-- MARKDOWN-AUTO-DOCS:END -->\r\n"
+        )
+
+        self.assertEqual(
+            self._prepare(content),
+            (
+                True,
+                b"Text\r\n"
+                b"<!-- MARKDOWN-AUTO-DOCS:START (CODE:src=src.py&lines=1-3) -->\r\n"
+                b"<!-- MARKDOWN-AUTO-DOCS:END -->\r\n",
+            ),
+        )
+
+    def test_marker_without_label_is_kept(self):
+        content = (
+            b"<!-- MARKDOWN-AUTO-DOCS:START (CODE:src=other.json&lines=53-57) -->\n"
+            b"<!-- MARKDOWN-AUTO-DOCS:END -->\n"
+        )
+
+        self.assertEqual(self._prepare(content), (False, content))
+
+    def test_markers_sharing_a_source(self):
+        content = (
+            b"<!-- MARKDOWN-AUTO-DOCS:START (CODE:src=src.py&label=foo) -->\n"
+            b"<!-- MARKDOWN-AUTO-DOCS:START (CODE:src=src.py&label=bar) -->\n"
+            b"<!-- MARKDOWN-AUTO-DOCS:START (CODE:src=src.py&label=foo) -->\n"
+        )
+
+        with mock.patch("os.path.abspath", wraps=os.path.abspath) as abspath:
+            is_replaced, output = self._prepare(content)
+        self.assertEqual(abspath.call_count, 1)
+
+        self.assertTrue(is_replaced)
+        self.assertEqual(
+            output,
+            b"<!-- MARKDOWN-AUTO-DOCS:START (CODE:src=src.py&lines=1-3) -->\n"
+            b"<!-- MARKDOWN-AUTO-DOCS:START (CODE:src=src.py&lines=5-6) -->\n"
+            b"<!-- MARKDOWN-AUTO-DOCS:START (CODE:src=src.py&lines=1-3) -->\n",
+        )
+
+    def test_missing_source_raises_runtime_error(self):
+        content = b"<!-- MARKDOWN-AUTO-DOCS:START (CODE:src=missing.py&label=foo) -->\n"
+
+        with self.assertRaisesRegex(RuntimeError, r"Tag \[foo\].*missing\.py"):
+            self._prepare(content)
+
+
+class RunAutodocTest(unittest.TestCase):
+    def test_missing_docker_raises_runtime_error(self):
+        with mock.patch.dict(os.environ, {"PATH": ""}):
+            with self.assertRaisesRegex(RuntimeError, "Command run unsuccessful"):
+                code_block.run_autodoc(["README.md"])
+
+    def test_single_path_is_rejected(self):
+        with mock.patch("subprocess.run") as run:
+            with self.assertRaisesRegex(TypeError, "list of markdown paths"):
+                code_block.run_autodoc("README.md")
+        run.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()